@@ -1,33 +1,165 @@
 # %%
+import asyncio
+import copy
 import os
-from typing import Any, List, Optional
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Union
 
+import faiss
+import numpy as np
+from common import get_chat_model, get_embeddings, load_vectorstore, save_vectorstore
 from langchain.chains import RetrievalQA
-from langchain.chat_models import ChatOpenAI
 from langchain.docstore.document import Document
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.vectorstores import FAISS
+from numba import njit
+
+
+@njit("float32[:](float32[:])", cache=True)
+def _l2_to_similarity(distances):
+    """
+    FAISS が返す二乗 L2 距離を、0 から 1 の類似度に in-place で変換します。
+    OpenAI の埋め込みベクトルは長さ 1 に正規化されているので、二乗 L2 距離 d から cos 類似度 1 - d / 2 が求まります。
+    """
+    for i in range(distances.shape[0]):
+        distances[i] = min(max(1.0 - distances[i] / 2.0, 0.0), 1.0)
+    return distances
+
+
+def _match_filter(metadata, filter):
+    """
+    metadata が filter の条件に一致するかを返します。FAISS の filter と同じ形式を受け付けます。
+
+    Args:
+        metadata (dict): ドキュメントの metadata
+        filter (dict | callable): 絞り込む条件。dict の値がリストの場合は、いずれかに一致すれば一致とみなす
+
+    Returns:
+        bool: 一致すれば True
+    """
+    if callable(filter):
+        return filter(metadata)
+    return all(
+        metadata.get(key) in value if isinstance(value, list) else metadata.get(key) == value
+        for key, value in filter.items()
+    )
 
 
 class FaissWithScore(FAISS):
     """
     FaissWithScore は、 FAISS を継承したクラスです。FAISS には、検索結果のスコアを取得する機能がないため、
     このクラスを使用することで、検索結果のスコアを取得できるようになります。
+    スコアは L2 距離ではなく、0 から 1 の類似度 (1 が最も近い) です。
     """
 
+    # 覚えておくクエリのベクトルの数
+    query_embedding_cache_size = 128
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """"""
+        super().__init__(*args, **kwargs)
+        # 同じクエリを何度もベクトル化しないよう、直近のクエリのベクトルを覚えておく
+        # 同期版と非同期版の検索で共有するので、lru_cache ではなく自前で持つ
+        self._query_embeddings = OrderedDict()
+        self._query_embeddings_lock = threading.Lock()
+
+    def _get_query_embedding(self, query: str) -> Optional[List[float]]:
+        """覚えているクエリのベクトルを返します。なければ None を返します。"""
+        with self._query_embeddings_lock:
+            embedding = self._query_embeddings.get(query)
+            if embedding is not None:
+                self._query_embeddings.move_to_end(query)
+            return embedding
+
+    def _set_query_embedding(self, query: str, embedding: List[float]) -> None:
+        """クエリのベクトルを覚えます。query_embedding_cache_size を超えたら古いものから忘れます。"""
+        with self._query_embeddings_lock:
+            self._query_embeddings[query] = embedding
+            self._query_embeddings.move_to_end(query)
+            while len(self._query_embeddings) > self.query_embedding_cache_size:
+                self._query_embeddings.popitem(last=False)
+
+    def embed_query(self, query: str) -> List[float]:
+        """
+        クエリをベクトル化します。直近にベクトル化したクエリであれば、API を呼ばずに前回のベクトルを返します。
+        """
+        embedding = self._get_query_embedding(query)
+        if embedding is None:
+            embedding = self._embed_query(query)
+            self._set_query_embedding(query, embedding)
+        return embedding
+
+    async def aembed_query(self, query: str) -> List[float]:
+        """
+        embed_query の非同期版です。
+        """
+        embedding = self._get_query_embedding(query)
+        if embedding is None:
+            embedding = await self._aembed_query(query)
+            self._set_query_embedding(query, embedding)
+        return embedding
+
     def similarity_search(self, query: str, k: int = 5, **kwargs: Any) -> List[Document]:
         """
         指定したクエリに最も近いドキュメントを FAISS から取得します。
         このメソッドは、 FAISS の similarity_search メソッドをオーバーライドしています。
         """
-        # 検索結果のスコアを取得する
-        docs_with_score = super().similarity_search_with_score(query, k)
+        return self.similarity_search_by_vector(self.embed_query(query), k, **kwargs)
+
+    async def asimilarity_search(self, query: str, k: int = 5, **kwargs: Any) -> List[Document]:
+        """
+        similarity_search の非同期版です。待つのはクエリのベクトル化だけで、FAISS の検索はそのまま行います。
+        このメソッドは、 FAISS の asimilarity_search メソッドをオーバーライドしています。
+        """
+        return self.similarity_search_by_vector(await self.aembed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 5,
+        filter: Optional[Union[Dict[str, Any], Callable[[Dict[str, Any]], bool]]] = None,
+        fetch_k: int = 20,
+        score_threshold: Optional[float] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        """
+        指定したベクトルに最も近いドキュメントを、スコア付きで FAISS から取得します。
+        このメソッドは、 FAISS の similarity_search_by_vector メソッドをオーバーライドしています。
+
+        Args:
+            embedding (list): クエリのベクトル
+            k (int): 取得するドキュメントの数
+            filter (dict | callable): metadata で絞り込む条件。dict の値がリストの場合は、いずれかに一致すれば残す
+            fetch_k (int): filter を指定したときに、絞り込む前に FAISS から取得するドキュメントの数
+            score_threshold (float): これ未満の類似度のドキュメントを除く。FAISS と違い、スコアは距離ではなく類似度
+
+        Returns:
+            list: metadata["score"] に類似度を入れた Document オブジェクトのリスト
+        """
+        if kwargs:
+            raise TypeError(f"similarity_search_by_vector() got unexpected keyword arguments: {', '.join(kwargs)}")
+
+        # インデックスから距離を取得して類似度に変換する
+        # filter で除かれる分を見込んで、filter があるときは多めに取得する
+        vector = np.array([embedding], dtype=np.float32)
+        distances, indices = self.index.search(vector, k if filter is None else max(k, fetch_k))
+        scores = _l2_to_similarity(distances[0])
 
         # 検索結果のスコアをドキュメントに追加する
+        # docstore 内のドキュメントは他の検索と共有しているので、metadata は書き換えずにコピーする
         docs = []
-        for doc, score in docs_with_score:
-            doc.metadata["score"] = score
-            docs.append(doc)
+        for i, score in zip(indices[0], scores):
+            # ドキュメント数が k より少ないと -1 が返る
+            if i == -1:
+                continue
+            if score_threshold is not None and score < score_threshold:
+                continue
+            doc = self.docstore.search(self.index_to_docstore_id[i])
+            if filter is not None and not _match_filter(doc.metadata, filter):
+                continue
+            docs.append(Document(page_content=doc.page_content, metadata={**doc.metadata, "score": float(score)}))
+            if len(docs) == k:
+                break
         return docs
 
 
@@ -39,47 +171,85 @@ class Agent:
     主なメソッド:
     - initialize_chain: FAISS を初期化し、QA チェーンを作成します。
     - run: 質問に対する回答を取得します。必要に応じて QA チェーンを初期化します。
+      意味の近い質問に過去に回答していれば、その回答をキャッシュから返します。
+    - arun: run の非同期版です。
 
     使用例:
     qa_agent = Agent()
     result = qa_agent.run("質問のテキスト")
+    result = await qa_agent.arun("質問のテキスト")
     """
 
     def __init__(
-        self, vector_store_folder_path: str = "vector_store_faiss", vector_store_index_name: str = "index"
+        self,
+        vector_store_folder_path: str = "vector_store_faiss",
+        vector_store_index_name: str = "index",
+        query_cache_folder_path: str = "query_cache_faiss",
+        query_cache_threshold: float = 0.04,
+        query_cache_save_interval: int = 10,
+        hnsw_ef_search: int = 64,
+        ivf_nprobe: int = 8,
     ) -> None:
         """
         Agent インスタンスを初期化します。qa_chain は None に設定されます。
+
+        query_cache_threshold は、キャッシュ済みの質問とみなす二乗 L2 距離の上限です。
+        OpenAI の埋め込みベクトルは長さ 1 なので、二乗 L2 距離 d は cos 類似度 1 - d / 2 に対応します。
+        デフォルトの 0.04 は cos 類似度 0.98 以上で、言い回しが違うだけの同じ質問にだけヒットするようにしています。
+        query_cache_save_interval 件の回答をキャッシュに追加するごとに、キャッシュをディスクに保存します。
+        hnsw_ef_search は、HNSW インデックスを検索するときの探索幅です。大きいほど正確になり、遅くなります。
+        ivf_nprobe は、IVF インデックスを検索するときに調べるクラスタの数です。大きいほど正確になり、遅くなります。
         """
         self.qa_chain = None
         self.vector_store_folder_path = vector_store_folder_path
         self.vector_store_index_name = vector_store_index_name
+        self.hnsw_ef_search = hnsw_ef_search
+        self.ivf_nprobe = ivf_nprobe
+
+        self.vectorstore = None
+        self.embeddings = None
+
+        # 質問のベクトルをキー、回答を値として持つ FAISS
+        self.query_cache = None
+        self.query_cache_folder_path = query_cache_folder_path
+        self.query_cache_threshold = query_cache_threshold
+        self.query_cache_save_interval = query_cache_save_interval
+        self._query_cache_lock = threading.Lock()
+        self._initialize_lock = threading.Lock()
+        self._unsaved_query_count = 0
 
     def initialize_chain(self):
         """
         FAISS を初期化し、QA チェーンを作成します。環境変数から OpenAI の API キーと環境を取得し、
         それらを使用して FAISS を初期化します。その後、ベクトルストアを用いた検索機能を持つ QA チェーンを作成します。
         """
-        # vectore store として FAISS を使用
-        embeddings = OpenAIEmbeddings()
-
         # 環境変数から OpenAI の API キーと環境を取得
         try:
             self.openai_api_key = os.environ["OPENAI_API_KEY"]
         except:
             raise Exception("OPENAI_API_KEY を環境変数に設定してください")
 
+        # vectore store として FAISS を使用
+        embeddings = get_embeddings()
+
         # vectore store を初期化
-        vectorstore = FaissWithScore.load_local(
+        vectorstore = load_vectorstore(
+            FaissWithScore,
             folder_path=self.vector_store_folder_path,
             embeddings=embeddings,
             index_name=self.vector_store_index_name,
         )
+        self._tune_index(vectorstore.index)
+
+        # 過去の質問と回答のキャッシュがあれば読み込む
+        self.query_cache = self._load_query_cache(embeddings, vectorstore.build_id)
+        self.embeddings = embeddings
+        self.vectorstore = vectorstore
 
         # qa chain を作成
         retriever = vectorstore.as_retriever()
         qa_chain = RetrievalQA.from_chain_type(
-            llm=ChatOpenAI(model_name="gpt-4", temperature=0),
+            llm=get_chat_model(),
             chain_type="stuff",
             retriever=retriever,
             verbose=True,
@@ -87,6 +257,18 @@ class Agent:
         )
         self.qa_chain = qa_chain
 
+    def _tune_index(self, index):
+        """
+        インデックスの種類に応じて、検索時のパラメータを設定します。
+
+        Args:
+            index (faiss.Index): vector store のインデックス
+        """
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = self.hnsw_ef_search
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.ivf_nprobe
+
     def run(self, prompt):
         """
         質問に対する回答を取得します。QA チェーンが初期化されていない場合、initialize_chain メソッドを使用して初期化します。
@@ -99,12 +281,70 @@ class Agent:
             dict: 回答テキストと関連情報を含む辞書
         """
         # qa chain がなければ作成
-        if self.qa_chain is None:
-            self.initialize_chain()
+        self._ensure_chain()
+
+        # 意味の近い質問に回答済みであれば、その回答を返す
+        # ここでのベクトルは vectorstore が覚えているので、この後の検索で再度ベクトル化されることはない
+        query_vector = self.vectorstore.embed_query(prompt)
+        cached_result = self._lookup_query_cache(query_vector)
+        if cached_result is not None:
+            return cached_result
 
         # 質問に対する回答を取得する
-        result = {}
         answer = self.qa_chain(prompt)
+        result = self._build_result(answer)
+        self._add_to_query_cache(prompt, query_vector, result)
+        return result
+
+    async def arun(self, prompt):
+        """
+        run の非同期版です。OpenAI の API を待つ間にほかの質問を処理できるので、複数の質問を並行に捌けます。
+
+        Args:
+            prompt (str): 質問のテキスト
+
+        Returns:
+            dict: 回答テキストと関連情報を含む辞書
+        """
+        # ファイルの読み込みやキャッシュの保存、ロック待ちでイベントループを止めないよう、スレッドで実行する
+        loop = asyncio.get_running_loop()
+
+        # qa chain がなければ作成
+        await loop.run_in_executor(None, self._ensure_chain)
+
+        # 意味の近い質問に回答済みであれば、その回答を返す
+        query_vector = await self.vectorstore.aembed_query(prompt)
+        cached_result = await loop.run_in_executor(None, self._lookup_query_cache, query_vector)
+        if cached_result is not None:
+            return cached_result
+
+        # 質問に対する回答を取得する
+        answer = await self.qa_chain.ainvoke(prompt)
+        result = self._build_result(answer)
+        await loop.run_in_executor(None, self._add_to_query_cache, prompt, query_vector, result)
+        return result
+
+    def _ensure_chain(self):
+        """
+        QA チェーンが初期化されていなければ初期化します。複数のスレッドから呼ばれても初期化は 1 度だけです。
+        """
+        if self.qa_chain is not None:
+            return
+        with self._initialize_lock:
+            if self.qa_chain is None:
+                self.initialize_chain()
+
+    def _build_result(self, answer):
+        """
+        QA チェーンの出力から、回答テキストと関連情報を含む辞書を作ります。
+
+        Args:
+            answer (dict): QA チェーンの出力
+
+        Returns:
+            dict: 回答テキストと関連情報を含む辞書
+        """
+        result = {}
         result["answer_text"] = answer["result"]
         result["source_documents"] = [
             {
@@ -116,6 +356,72 @@ class Agent:
         ]
         return result
 
+    def _load_query_cache(self, embeddings, build_id):
+        """
+        ディスクに保存された質問と回答のキャッシュを読み込みます。
+        キャッシュは作り直せるので、ない場合や古い形式・壊れている場合は空の状態から始めます。
+        vector store が作り直されていれば、キャッシュの回答は古いので捨てます。
+
+        Args:
+            embeddings (Embeddings): クエリの埋め込みに使うモデル
+            build_id (str): 読み込んだ vector store の build_id
+
+        Returns:
+            FAISS: 読み込んだキャッシュ。読み込めなければ None
+        """
+        if not os.path.isdir(self.query_cache_folder_path):
+            return None
+        try:
+            query_cache = load_vectorstore(FAISS, folder_path=self.query_cache_folder_path, embeddings=embeddings)
+        except (FileNotFoundError, ValueError, RuntimeError) as e:
+            print(f"Query cache could not be loaded, starting empty: {e}")
+            return None
+        if query_cache.build_id != build_id:
+            print("Query cache was built from a different vector store, starting empty.")
+            return None
+        return query_cache
+
+    def _lookup_query_cache(self, query_vector):
+        """
+        キャッシュから質問に最も近い過去の質問を探し、二乗 L2 距離が query_cache_threshold 未満であればその回答を返します。
+
+        Args:
+            query_vector (list): 質問のベクトル
+
+        Returns:
+            dict: キャッシュされた回答。見つからなければ None
+        """
+        with self._query_cache_lock:
+            if self.query_cache is None:
+                return None
+            docs_with_score = self.query_cache.similarity_search_with_score_by_vector(query_vector, k=1)
+        if docs_with_score and docs_with_score[0][1] < self.query_cache_threshold:
+            # キャッシュの中身を呼び出し側に書き換えられないよう、コピーを返す
+            return copy.deepcopy(docs_with_score[0][0].metadata)
+        return None
+
+    def _add_to_query_cache(self, prompt, query_vector, result):
+        """
+        質問と回答をキャッシュに追加し、query_cache_save_interval 件ごとにディスクに保存します。
+
+        Args:
+            prompt (str): 質問のテキスト
+            query_vector (list): 質問のベクトル
+            result (dict): 回答テキストと関連情報を含む辞書
+        """
+        # result は呼び出し側にも返すので、書き換えられても影響しないようコピーを持つ
+        result = copy.deepcopy(result)
+        with self._query_cache_lock:
+            if self.query_cache is None:
+                self.query_cache = FAISS.from_embeddings([(prompt, query_vector)], self.embeddings, metadatas=[result])
+            else:
+                self.query_cache.add_embeddings([(prompt, query_vector)], metadatas=[result])
+
+            self._unsaved_query_count += 1
+            if self._unsaved_query_count >= self.query_cache_save_interval:
+                save_vectorstore(self.query_cache, self.query_cache_folder_path, build_id=self.vectorstore.build_id)
+                self._unsaved_query_count = 0
+
 
 if __name__ == "__main__":
     agent = Agent()
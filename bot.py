@@ -1,5 +1,6 @@
 # %%
 import os
+import re
 
 from agent import Agent
 from slack_bolt import App
@@ -18,6 +19,13 @@ app = App(token=SLACK_BOT_TOKEN)
 qa = Agent()
 
 
+def _strip_mentions(text):
+    """メッセージ本文からメンション (<@U0123ABCD>) を取り除く
+    メンションは質問の内容と関係ないうえ、すべての質問の先頭に付くので、回答のキャッシュで別の質問同士が近く見えてしまう
+    """
+    return re.sub(r"<@[A-Z0-9]+(\|[^>]*)?>", "", text).strip()
+
+
 def _message_builder(event, result):
     """返信するメッセージを作成する
     雰囲気以下のようなかんじ
@@ -53,10 +61,15 @@ def respond_to_mention(event, say):
     print(event)
 
     # 質問に対する回答を取得する
-    try:
-        result = qa.run(event["text"])
-    except Exception as e:
-        result = {"answer_text": f"エラーがおきました :しゅん: \n```{e.args}\n```", "source_documents": []}
+    # メンションだけで質問がなければ、API を呼ばずに質問を促す
+    prompt = _strip_mentions(event["text"])
+    if not prompt:
+        result = {"answer_text": "質問をメンションと一緒に書いてください。", "source_documents": []}
+    else:
+        try:
+            result = qa.run(prompt)
+        except Exception as e:
+            result = {"answer_text": f"エラーがおきました :しゅん: \n```{e.args}\n```", "source_documents": []}
 
     # 返信するメッセージを作成
     message = _message_builder(event, result)
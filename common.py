@@ -0,0 +1,113 @@
+# %%
+import functools
+import os
+import uuid
+
+import faiss
+import orjson
+from langchain.chat_models import ChatOpenAI
+from langchain.docstore import InMemoryDocstore
+from langchain.docstore.document import Document
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+
+@functools.lru_cache(maxsize=1)
+def get_embeddings():
+    """
+    OpenAIEmbeddings のインスタンスを返します。
+    生成のたびに環境変数の読み込みや OpenAI クライアント、tiktoken のエンコーダーの作成が走るため、
+    プロセス内では 1 つのインスタンスを使い回します。
+
+    Returns:
+        OpenAIEmbeddings: 埋め込みに使うモデル
+    """
+    return OpenAIEmbeddings()
+
+
+@functools.lru_cache(maxsize=1)
+def get_chat_model():
+    """
+    回答の生成に使う ChatOpenAI のインスタンスを返します。get_embeddings と同様に使い回します。
+
+    Returns:
+        ChatOpenAI: 回答の生成に使うモデル
+    """
+    return ChatOpenAI(model_name="gpt-4", temperature=0)
+
+
+def save_vectorstore(vectorstore, folder_path, index_name="index", build_id=None):
+    """
+    FAISS の vector store を保存します。
+    FAISS.save_local は docstore を pickle で保存しますが、ここではインデックスを faiss の形式で、
+    ドキュメントを orjson で JSON として保存します。読み込みが速く、読み込み時に任意のコードが実行されることもありません。
+
+    Args:
+        vectorstore (FAISS): 保存する vector store
+        folder_path (str): 保存先のフォルダ
+        index_name (str): 保存するファイル名 (拡張子なし)
+        build_id (str): どの vector store から作られたかを表す ID。省略すると新しい ID を振ります
+    """
+    if build_id is None:
+        build_id = uuid.uuid4().hex
+    os.makedirs(folder_path, exist_ok=True)
+    index_path = os.path.join(folder_path, f"{index_name}.faiss")
+    json_path = os.path.join(folder_path, f"{index_name}.json")
+
+    # インデックスの i 番目のベクトルが documents の i 番目のドキュメントに対応する
+    ids = [vectorstore.index_to_docstore_id[i] for i in range(len(vectorstore.index_to_docstore_id))]
+    documents = []
+    for docstore_id in ids:
+        doc = vectorstore.docstore.search(docstore_id)
+        documents.append({"page_content": doc.page_content, "metadata": doc.metadata})
+
+    # 書き込み途中で落ちても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+    faiss.write_index(vectorstore.index, f"{index_path}.tmp")
+    with open(f"{json_path}.tmp", "wb") as f:
+        f.write(orjson.dumps({"build_id": build_id, "ids": ids, "documents": documents}, option=orjson.OPT_SERIALIZE_NUMPY))
+    os.replace(f"{index_path}.tmp", index_path)
+    os.replace(f"{json_path}.tmp", json_path)
+
+
+def load_vectorstore(cls, folder_path, embeddings, index_name="index"):
+    """
+    save_vectorstore で保存した vector store を読み込みます。保存時の build_id は、読み込んだ vector store の build_id 属性に入ります。
+
+    Args:
+        cls (type): 読み込む vector store のクラス (FAISS またはそのサブクラス)
+        folder_path (str): 保存先のフォルダ
+        embeddings (Embeddings): クエリの埋め込みに使うモデル
+        index_name (str): 保存したファイル名 (拡張子なし)
+
+    Returns:
+        FAISS: 読み込んだ vector store
+
+    Raises:
+        FileNotFoundError: 保存されたファイルがない、または FAISS.save_local の古い形式 (.pkl) で保存されている場合
+        ValueError: .faiss と .json の内容が一致しない場合
+    """
+    index_path = os.path.join(folder_path, f"{index_name}.faiss")
+    json_path = os.path.join(folder_path, f"{index_name}.json")
+    if not os.path.exists(json_path):
+        if os.path.exists(os.path.join(folder_path, f"{index_name}.pkl")):
+            raise FileNotFoundError(
+                f"{folder_path} は古い形式 ({index_name}.pkl) で保存されています。store_to_vectordb.py を実行して作り直してください"
+            )
+        raise FileNotFoundError(f"{json_path} がありません。store_to_vectordb.py を実行して作成してください")
+
+    index = faiss.read_index(index_path)
+    with open(json_path, "rb") as f:
+        data = orjson.loads(f.read())
+    # .faiss と .json の置き換えの間で落ちた場合は、ベクトルとドキュメントの数が合わなくなる
+    if index.ntotal != len(data["ids"]):
+        raise ValueError(f"{folder_path} の {index_name}.faiss と {index_name}.json の内容が一致しません")
+
+    docstore = InMemoryDocstore(
+        {
+            docstore_id: Document(page_content=doc["page_content"], metadata=doc["metadata"])
+            for docstore_id, doc in zip(data["ids"], data["documents"])
+        }
+    )
+    index_to_docstore_id = dict(enumerate(data["ids"]))
+    vectorstore = cls(embeddings, index, docstore, index_to_docstore_id)
+    vectorstore.build_id = data.get("build_id")
+    return vectorstore
@@ -1,16 +1,49 @@
 # %%
+import asyncio
+import functools
 import gc
+import multiprocessing
 import os
 import shutil
+import threading
 import time
 import urllib.parse
-
-import requests
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import faiss
+import numpy as np
+import requests_cache
+from common import get_embeddings, save_vectorstore
+from langchain.docstore import InMemoryDocstore
 from langchain.docstore.document import Document
-from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import FAISS
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util.retry import Retry
+
+
+def _run_coroutine(coroutine_function):
+    """
+    同期的なコードからコルーチンを実行し、その結果を返します。
+    Jupyter や VS Code の Interactive Window のように、すでにイベントループが動いているスレッドでは asyncio.run が使えないので、
+    その場合は別のスレッドで実行して結果を待ちます。
+
+    Args:
+        coroutine_function (callable): 実行するコルーチンを返す関数
+
+    Returns:
+        Any: コルーチンの戻り値
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine_function())
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(lambda: asyncio.run(coroutine_function())).result()
 
 
 class VectorStore:
@@ -21,10 +54,38 @@ class VectorStore:
     - store_to_vectoredb: ドキュメントをベクトル化し、ベクトルストアに保存します。
     """
 
-    def __init__(self, folder_path: str = "vector_store_faiss", index_name: str = "index") -> None:
+    def __init__(
+        self,
+        folder_path: str = "vector_store_faiss",
+        index_name: str = "index",
+        batching: str = "token_budget",
+        max_batch_tokens: int = 8000,
+        max_concurrency: int = 8,
+        embedding_cache_path: str = ".embedding_cache",
+        cache_lookup_batch_bytes: int = 4096,
+        index_type: str = "hnsw",
+        hnsw_m: int = 32,
+        hnsw_ef_construction: int = 200,
+    ) -> None:
         """"""
         self.folder_path = folder_path
         self.index_name = index_name
+        # 一度ベクトル化したテキストは、テキストのハッシュをキーにしてここに保存しておく
+        self.embedding_cache_path = embedding_cache_path
+        # キャッシュを引くときに 1 回でまとめて問い合わせるキーの合計サイズ (byte)。個数はキーの長さから決める
+        self.cache_lookup_batch_bytes = cache_lookup_batch_bytes
+        # インデックスの種類 ("hnsw" または "ivf")
+        self.index_type = index_type
+        # HNSW インデックスのノードあたりのリンク数と、構築時の探索幅
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        # 1 リクエストあたりのトークン数と、同時に投げるリクエスト数の上限 (429 対策)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        # batch の作り方 ("token_budget" または "api")。_embed_texts を参照
+        if batching not in ("token_budget", "api"):
+            raise ValueError(f"batching には token_budget か api を指定してください: {batching}")
+        self.batching = batching
 
     def delete_all_indexes(self):
         """
@@ -40,14 +101,282 @@ class VectorStore:
         Args:
             documents (list): Document オブジェクトのリスト
         """
+        texts = [doc.page_content for doc in documents]
+        metadatas = [doc.metadata for doc in documents]
+
         # documents をベクトル化して vectore store に保存する
-        embeddings = OpenAIEmbeddings()
-        vectorestore = FAISS.from_documents(documents, embeddings)
-        vectorestore.save_local(self.folder_path, self.index_name)
+        # 前回から変わっていないテキストはキャッシュから読み、API は呼ばない
+        underlying_embeddings = get_embeddings()
+        embeddings = CacheBackedEmbeddings.from_bytes_store(
+            underlying_embeddings,
+            LocalFileStore(self.embedding_cache_path),
+            namespace=underlying_embeddings.model,
+        )
+        vectors = self._embed_texts_with_cache(embeddings, texts)
+        vectorestore = self._build_vectorstore(embeddings, texts, vectors, metadatas)
+        save_vectorstore(vectorestore, self.folder_path, self.index_name)
         del vectorestore
         gc.collect()
         print(f"Saved vectorstore to {self.folder_path}, with index name {self.index_name}.")
 
+    def _build_vectorstore(self, embeddings, texts, vectors, metadatas):
+        """
+        ベクトルからインデックスを構築し、FAISS の vector store を作ります。
+
+        Args:
+            embeddings (Embeddings): クエリの埋め込みに使うモデル
+            texts (list): テキストのリスト
+            vectors (list): texts と同じ順番に並んだベクトルのリスト
+            metadatas (list): texts と同じ順番に並んだ metadata のリスト
+
+        Returns:
+            FAISS: 構築した vector store
+        """
+        # 距離計算に使われる SIMD 命令 (AVX2, AVX512 など) は、読み込まれた FAISS の build で決まる
+        print(f"FAISS compile options: {faiss.get_compile_options()}")
+        index = self._build_index(np.array(vectors, dtype=np.float32))
+        vectorestore = FAISS(embeddings, index, InMemoryDocstore({}), {})
+        vectorestore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+        return vectorestore
+
+    def _build_index(self, vectors):
+        """
+        index_type に応じたインデックスを作り、vectors で学習させます。
+        どちらも全件を総当たりする IndexFlatL2 と違い、ドキュメント数が増えても検索時間がほとんど増えません。
+        ベクトルは FP32 ではなく 8bit に量子化して保持するので、インデックスのサイズは約 1/4 になります。
+
+        - hnsw: グラフを辿って検索する HNSW インデックス
+        - ivf: ベクトルを sqrt(N) 個程度のクラスタに分け、クエリに近いクラスタだけを検索する IVF インデックス。
+          クラスタへの追加が軽いので、差分だけを追加していく場合に向いています。
+
+        Args:
+            vectors (np.ndarray): 学習に使うベクトル
+
+        Returns:
+            faiss.Index: 学習済みで、まだベクトルを追加していないインデックス
+        """
+        num_vectors, dimension = vectors.shape
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit, self.hnsw_m)
+            index.hnsw.efConstruction = self.hnsw_ef_construction
+        elif self.index_type == "ivf":
+            # クラスタ数はベクトル数を超えられない
+            nlist = min(max(32, int(num_vectors**0.5)), num_vectors)
+            quantizer = faiss.IndexFlatL2(dimension)
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2
+            )
+        else:
+            raise ValueError(f"index_type には hnsw か ivf を指定してください: {self.index_type}")
+
+        # 量子化の範囲 (と IVF のクラスタ) を決めるため、ベクトルを追加する前に学習させる
+        index.train(vectors)
+        return index
+
+    @staticmethod
+    def _estimate_tokens(text):
+        """
+        text のおおよそのトークン数を返します。
+        日本語はおおむね 1 文字 1 トークンになるので、文字数で近似します。
+        """
+        return len(text)
+
+    def _make_batches(self, texts):
+        """
+        texts をトークン数の多い順に並べ、1 batch あたり max_batch_tokens 以内になるようにまとめます。
+        長さの近いテキスト同士が同じ batch に入るので、batch ごとのコストが揃います。
+
+        Args:
+            texts (list): ベクトル化するテキストのリスト
+
+        Returns:
+            list: batch ごとの、texts 中のインデックスのリスト
+        """
+        tokens = [self._estimate_tokens(text) for text in texts]
+        order = sorted(range(len(texts)), key=lambda i: tokens[i], reverse=True)
+
+        batches = []
+        batch, batch_tokens = [], 0
+        for i in order:
+            # max_batch_tokens を超える場合は batch を締める (1 つで超えるテキストは単独の batch にする)
+            if batch and batch_tokens + tokens[i] > self.max_batch_tokens:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens[i]
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _embed_texts_with_cache(self, embeddings, texts):
+        """
+        texts のベクトルをキャッシュから取得し、キャッシュにないテキストだけを API でベクトル化してキャッシュに保存します。
+        キャッシュの問い合わせはテキストごとではなく、キーの合計が cache_lookup_batch_bytes 程度になる個数ずつまとめて 1 回で行います。
+
+        Args:
+            embeddings (CacheBackedEmbeddings): キャッシュ付きの埋め込みモデル
+            texts (list): ベクトル化するテキストのリスト
+
+        Returns:
+            list: texts と同じ順番に並んだベクトルのリスト
+        """
+        store = embeddings.document_embedding_store
+        # キーは namespace にテキストの UUID (36 文字) を付けた文字列で、長さはテキストによらず一定
+        key_size = len(store.key_encoder("").encode())
+        batch_size = max(1, self.cache_lookup_batch_bytes // key_size)
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            vectors += store.mget(texts[i : i + batch_size])
+
+        missing_indices = [i for i, vector in enumerate(vectors) if vector is None]
+        print(f"Found {len(texts) - len(missing_indices)} of {len(texts)} embeddings in cache.")
+        if missing_indices:
+            missing_texts = [texts[i] for i in missing_indices]
+            missing_vectors = self._embed_texts(embeddings.underlying_embeddings, missing_texts)
+            store.mset(list(zip(missing_texts, missing_vectors)))
+            for i, vector in zip(missing_indices, missing_vectors):
+                vectors[i] = vector
+        return vectors
+
+    def _embed_texts(self, embeddings, texts):
+        """
+        texts をまとめてベクトル化します。ベクトル化はすべてここを通ります。
+        batching によって batch の作り方が変わります。
+
+        - token_budget: _aembed_texts で max_batch_tokens ごとの batch を作り、max_concurrency 個まで並行に送ります。
+        - api: コーパス全体を 1 回の embed_documents に渡し、API の上限いっぱいの batch に分けて順に送ります。
+
+        Args:
+            embeddings (Embeddings): 埋め込みに使うモデル
+            texts (list): ベクトル化するテキストのリスト
+
+        Returns:
+            list: texts と同じ順番に並んだベクトルのリスト
+        """
+        if self.batching == "api":
+            print(f"Embedding {len(texts)} documents ...")
+            return embeddings.embed_documents(texts)
+        return _run_coroutine(lambda: self._aembed_texts(embeddings, texts))
+
+    async def _aembed_texts(self, embeddings, texts):
+        """
+        texts をトークン数で batch に分け、埋め込み API を並行に呼び出してベクトル化します。
+        同時に投げるリクエスト数は max_concurrency までに制限します。
+
+        Args:
+            embeddings (Embeddings): 埋め込みに使うモデル
+            texts (list): ベクトル化するテキストのリスト
+
+        Returns:
+            list: texts と同じ順番に並んだベクトルのリスト
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed_batch(batch):
+            async with semaphore:
+                return await embeddings.aembed_documents([texts[i] for i in batch])
+
+        batches = self._make_batches(texts)
+        print(f"Embedding {len(texts)} documents in {len(batches)} batches ...")
+        results = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+
+        # batch ごとの結果を元の順番に戻す
+        vectors = [None] * len(texts)
+        for batch, result in zip(batches, results):
+            for i, vector in zip(batch, result):
+                vectors[i] = vector
+        return vectors
+
+
+class RateLimiter:
+    """
+    RateLimiter は、ホストごとにリクエストの間隔を空けるためのクラスです。
+    複数のスレッドから呼ばれても、同じホストへのリクエストは interval 秒に 1 回までになります。
+    """
+
+    def __init__(self, interval: float = 1.0) -> None:
+        """"""
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_slots = {}
+
+    def wait(self, url):
+        """
+        url のホストに次にリクエストしてよい時刻まで待ちます。
+
+        Args:
+            url (str): アクセスする URL
+        """
+        host = urllib.parse.urlparse(url).netloc
+        # 枠の予約だけをロック内で行い、待つのはロックの外で行う
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slots.get(host, now))
+            self._next_slots[host] = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RateLimitedHTTPAdapter(HTTPAdapter):
+    """
+    RateLimitedHTTPAdapter は、実際に通信する直前に RateLimiter で待つ HTTPAdapter です。
+    キャッシュから返せるリクエストはこのアダプターまで届かないので、待たずに済みます。
+    """
+
+    def __init__(self, rate_limiter: RateLimiter, **kwargs: Any) -> None:
+        """"""
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        """"""
+        self.rate_limiter.wait(request.url)
+        return super().send(request, **kwargs)
+
+
+# 各ワーカープロセスで使う splitter。ドキュメントごとに pickle しないよう、ワーカーの起動時に 1 度だけ作る
+_splitter = None
+
+
+def _make_splitter(chunk_size, chunk_overlap):
+    """
+    ドキュメントの分割に使う splitter を作ります。
+
+    Args:
+        chunk_size (int): 分割後のドキュメントの最大文字数
+        chunk_overlap (int): 分割したドキュメント同士で重複させる文字数
+
+    Returns:
+        RecursiveCharacterTextSplitter: splitter
+    """
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+    )
+
+
+def _init_splitter(chunk_size, chunk_overlap):
+    """
+    ワーカープロセスの splitter を初期化します。引数は _make_splitter と同じです。
+    """
+    global _splitter
+    _splitter = _make_splitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def _split_document(document):
+    """
+    ワーカープロセスの splitter で document を分割します。
+
+    Args:
+        document (Document): Document オブジェクト
+
+    Returns:
+        list: 分割された Document オブジェクトのリスト
+    """
+    return _splitter.split_documents([document])
+
 
 class SaitekiManualHandler:
     """
@@ -59,27 +388,70 @@ class SaitekiManualHandler:
     - get_documents_from_urls: 与えられた URL からドキュメントを取得します。
     """
 
-    def __init__(self) -> None:
-        pass
+    # 分割後のドキュメントの最大文字数と、分割したドキュメント同士で重複させる文字数
+    CHUNK_SIZE = 1000
+    CHUNK_OVERLAP = 50
+    # この数以上のドキュメントを分割するときだけ、プロセスを立てて並列に分割する
+    PARALLEL_SPLIT_MIN_DOCUMENTS = 2000
+
+    def __init__(
+        self,
+        max_workers: int = 8,
+        request_interval: float = 1.0,
+        http_cache_name: str = "saiteki_http_cache",
+        http_cache_expire_after: int = 86400,
+    ) -> None:
+        """"""
+        self.max_workers = max_workers
+        # 同じコネクションを使い回すため、セッションを共有する
+        # 取得した HTML は http_cache_expire_after 秒の間ディスクにキャッシュし、再実行時は通信しない
+        self.session = requests_cache.CachedSession(
+            http_cache_name,
+            expire_after=http_cache_expire_after,
+            allowable_codes=(200,),
+        )
+        # DDos対策。ホストごとに request_interval 秒に 1 回までしかアクセスしない
+        adapter = RateLimitedHTTPAdapter(
+            RateLimiter(request_interval),
+            pool_connections=max_workers,
+            pool_maxsize=max_workers * 2,
+            # 429 や 5xx も待ってからやり直す。やり直しても失敗した場合は、最後のレスポンスを返して _request で例外にする
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def _request(self, url):
         """
-        url にアクセスし、取得した HTML を解析して BeautifulSoup オブジェクトを返します。
+        url にアクセスし、取得した HTML を解析して LexborHTMLParser オブジェクトを返します。
 
         Args:
             url (str): アクセスする URL
 
         Returns:
-            BeautifulSoup: 解析された HTML の BeautifulSoup オブジェクト
+            LexborHTMLParser: 解析された HTML の selectolax の LexborHTMLParser オブジェクト
+
+        Raises:
+            requests.HTTPError: やり直しても 200 番台以外のレスポンスが返ってきた場合
         """
         # url にアクセスする
         # headers は zendesk が定めるものを使う
         print(f"Accessing {url} ...")
-        res = requests.get(url=url, headers={"user-agent": "Zendesk/External-Content"})
-        soup = BeautifulSoup(res.text, "html.parser")
-        # DDos対策
-        time.sleep(1)
-        return soup
+        res = self.session.get(
+            url=url,
+            headers={"user-agent": "Zendesk/External-Content", "Accept-Encoding": "gzip, deflate"},
+        )
+        # 404 や 5xx のページを記事でないページとして黙って飛ばさないよう、ここで例外にする
+        res.raise_for_status()
+        tree = LexborHTMLParser(res.text)
+        # BeautifulSoup の .text と同じく、script や style の中身は本文に含めない
+        tree.strip_tags(["script", "style"])
+        return tree
 
     def _get_page_urls(self, url):
         """
@@ -93,11 +465,14 @@ class SaitekiManualHandler:
         """
 
         # 与えられた url にアクセス
-        soup = self._request(url)
+        tree = self._request(url)
         # その中で、食わせたいページの path を取得する
+        # class 属性が完全に一致するものだけを対象にする (同じユーティリティクラスを持つ別のリンクを拾わないため)
         paths = []
-        for x in soup.find_all("a", class_="u-w-12 u-h-12"):
-            paths.append(x.get("href"))
+        for x in tree.css('a[class="u-w-12 u-h-12"]'):
+            href = x.attributes.get("href")
+            if href:
+                paths.append(href)
         # path から url を取得する
         url_list = paths
         return url_list
@@ -110,17 +485,20 @@ class SaitekiManualHandler:
             url (str): 記事の URL
 
         Returns:
-            Document: 生成された Document オブジェクト
+            Document: 生成された Document オブジェクト。記事のページでなければ None
         """
         # 与えられた url にアクセス
-        soup = self._request(url)
-        # ページタイトルを取得（タイトル - ユーザ名）
-        title = soup.find("h1", class_="p-news-singleTitle M:u-size30 u-size24 u-700 u-color-blue_2 u-lh14 u-mb25").text
-        author = soup.find("ul", class_="c-list u-flex u-items-center u-wrap")
-        username = author.find("span", class_="u-size14").text
-        title = f"{title} - {username}"
-        # soup から div.article-body を取得する
-        body_text = soup.find("div", class_="c-editor u-mb75").text
+        tree = self._request(url)
+        # ページタイトル（タイトル - ユーザ名）と本文を取得する
+        title_node = tree.css_first('h1[class="p-news-singleTitle M:u-size30 u-size24 u-700 u-color-blue_2 u-lh14 u-mb25"]')
+        username_node = tree.css_first('ul[class="c-list u-flex u-items-center u-wrap"] span.u-size14')
+        body_node = tree.css_first('div[class="c-editor u-mb75"]')
+        # 記事のページでなければ、クロール全体を止めずにスキップする
+        if title_node is None or username_node is None or body_node is None:
+            print(f"Skipping {url}: not a case study page")
+            return None
+        title = f"{title_node.text()} - {username_node.text()}"
+        body_text = body_node.text()
         # ページ本文から document を作る
         metadata = {"source": url, "title": title}
         document = Document(page_content=body_text, metadata=metadata)
@@ -137,9 +515,9 @@ class SaitekiManualHandler:
             list: Document オブジェクトのリスト
         """
         print(f"Generating documents ...")
-        documents = []
-        for url in page_urls:
-            documents.append(self.generate_document(url))
+        # 通信待ちが大半なので、スレッドで並行にアクセスする
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            documents = [doc for doc in executor.map(self.generate_document, page_urls) if doc is not None]
         return documents
 
     def split_documents(self, documents):
@@ -153,13 +531,16 @@ class SaitekiManualHandler:
             list: 分割された Document オブジェクトのリスト
         """
         print(f"Splitting documents ...")
-        # documents を分割する
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=50,
-            length_function=len,
-        )
-        splitted_documents = splitter.split_documents(documents)
+        # ドキュメントが少ないうちは、プロセスを立ち上げるほうが分割より時間がかかるので、そのまま分割する
+        if len(documents) < self.PARALLEL_SPLIT_MIN_DOCUMENTS:
+            splitter = _make_splitter(chunk_size=self.CHUNK_SIZE, chunk_overlap=self.CHUNK_OVERLAP)
+            return splitter.split_documents(documents)
+
+        # ドキュメントごとに独立しているので、CPU コア数だけプロセスを立てて並列に分割する
+        initializer = functools.partial(_init_splitter, chunk_size=self.CHUNK_SIZE, chunk_overlap=self.CHUNK_OVERLAP)
+        with multiprocessing.Pool(os.cpu_count(), initializer=initializer) as pool:
+            results = pool.map(_split_document, documents)
+        splitted_documents = [doc for result in results for doc in result]
         return splitted_documents
 
     def get_documents_from_urls(self, urls):